@@ -0,0 +1,265 @@
+"""
+lib/client_selection.py
+
+Contains classes and functions related to choosing which YouTube player
+client to download with, based on how well each client has done for
+similar videos in this and previous runs
+"""
+
+import time
+import threading
+from pytubefix.exceptions import AgeRestrictedError
+
+# Kinds of video that clients are ranked for separately
+VIDEO_KIND_DEFAULT = "default"
+VIDEO_KIND_AGE_RESTRICTED = "age_restricted"
+
+# Outcome recorded for a successful attempt
+OUTCOME_SUCCESS = "success"
+
+# Errors that describe the video rather than the client. They are still
+# recorded, but do not count against a clients success rate
+VIDEO_OUTCOMES = (
+    "VideoUnavailable",
+    "VideoRegionBlocked",
+    "VideoPrivate",
+    "VideoRemovedByUploader",
+    "VideoRemovedByYouTubeForViolatingTOS",
+    "VideoBlockedByCopyright",
+    "AccountTerminated",
+    "MembersOnly",
+    "LiveStreamEnded",
+    "RecordingUnavailable"
+)
+
+class ClientStats(object):
+    """ Success and latency statistics per client, video kind, and
+    outcome, shared by all download threads and persisted in the DB
+
+    Methods:
+        __init__() - Initialize the object
+        load() - Load previously recorded statistics from the DB
+        save() - Add this runs statistics to the DB
+        record() - Record the outcome of a download attempt
+        ranked_clients() - Get clients ordered best first for a video kind
+    """
+
+    def __init__(self, config):
+        """ Initialize the objects instance
+
+        Arguments:
+            self - object - This object
+            config - ConfigParser object - Configuration data
+
+        Returns:
+            None
+        """
+
+        self.client_names = [name.strip() for name in config["Download"]["player_clients"].split(",") if name.strip() != ""]
+        self.half_life = float(config["Download"]["player_client_stats_half_life_days"]) * 24 * 60 * 60
+        self._lock = threading.Lock()
+        # (client, video_kind, outcome) -> [attempts, total_latency]
+        self._history = {}
+        self._new = {}
+
+    def _decay(self, age):
+        """ Get the weight of statistics recorded some time ago, so that
+        clients are ranked mostly by how they do now
+
+        Arguments:
+            self - object - This object
+            age - float - Seconds since the statistics were recorded
+
+        Returns:
+            weight - float - Weight between 0 and 1
+        """
+
+        weight = 0.5 ** (max(age, 0.0) / self.half_life)
+        return weight
+
+    def load(self, db_manager):
+        """ Load previously recorded statistics from the DB
+
+        Arguments:
+            self - object - This object
+            db_manager - DatabaseManager object - DB manager object instance
+
+        Returns:
+            None
+        """
+
+        now = time.time()
+        with self._lock:
+            for client, video_kind, outcome, attempts, total_latency, updated_at in db_manager.get_client_stats():
+                weight = self._decay(now - updated_at)
+                self._history[(client, video_kind, outcome)] = [attempts * weight, total_latency * weight]
+
+    def save(self, db_manager):
+        """ Add this runs statistics to the DB
+
+        Arguments:
+            self - object - This object
+            db_manager - DatabaseManager object - DB manager object instance
+
+        Returns:
+            is_success - bool - True if successful
+        """
+
+        with self._lock:
+            new_stats = self._new
+            self._new = {}
+
+        # Decay the stored totals to now before adding this runs outcomes
+        now = time.time()
+        stored_stats = {}
+        for client, video_kind, outcome, attempts, total_latency, updated_at in db_manager.get_client_stats():
+            weight = self._decay(now - updated_at)
+            stored_stats[(client, video_kind, outcome)] = (attempts * weight, total_latency * weight)
+
+        rows = []
+        for key, (attempts, total_latency) in new_stats.items():
+            stored_attempts, stored_latency = stored_stats.get(key, (0, 0.0))
+            rows.append(key + (stored_attempts + attempts, stored_latency + total_latency, now))
+
+        is_success = db_manager.set_client_stats(rows)
+        return is_success
+
+    def record(self, client, video_kind, outcome, latency):
+        """ Record the outcome of a download attempt
+
+        Arguments:
+            self - object - This object
+            client - string - Player client used
+            video_kind - string - Kind of video attempted
+            outcome - string - OUTCOME_SUCCESS or the error class name
+            latency - float - Seconds the attempt took
+
+        Returns:
+            None
+        """
+
+        key = (client, video_kind, outcome)
+        with self._lock:
+            for stats in (self._history, self._new):
+                entry = stats.setdefault(key, [0, 0.0])
+                entry[0] = entry[0] + 1
+                entry[1] = entry[1] + latency
+
+    def ranked_clients(self, video_kind):
+        """ Get clients ordered best first for a kind of video. Clients
+        are ranked by smoothed success rate, then by mean success latency.
+        Errors in VIDEO_OUTCOMES are left out of the success rate
+
+        Arguments:
+            self - object - This object
+            video_kind - string - Kind of video to rank clients for
+
+        Returns:
+            ranked_clients - list - Client names, best first
+        """
+
+        scores = {}
+        with self._lock:
+            for position, client in enumerate(self.client_names):
+                attempts = 0
+                successes = 0
+                success_latency = 0.0
+                for (stats_client, stats_kind, outcome), (count, total_latency) in self._history.items():
+                    if stats_client != client or stats_kind != video_kind:
+                        continue
+                    if outcome in VIDEO_OUTCOMES:
+                        continue
+                    attempts = attempts + count
+                    if outcome == OUTCOME_SUCCESS:
+                        successes = successes + count
+                        success_latency = success_latency + total_latency
+
+                # Untried clients start at an even chance rather than zero
+                success_rate = (successes + 1) / (attempts + 2)
+                if successes > 0:
+                    mean_latency = success_latency / successes
+                else:
+                    mean_latency = float("inf")
+                scores[client] = (-success_rate, mean_latency, position)
+
+        ranked_clients = sorted(self.client_names, key=lambda client: scores[client])
+        return ranked_clients
+
+class ClientSelector(object):
+    """ Chooses the client for each attempt of a single download thread
+
+    Methods:
+        __init__() - Initialize the object
+        next_client() - Choose the client for the next attempt
+        record_success() - Record that the last attempt succeeded
+        record_failure() - Record that the last attempt failed
+    """
+
+    def __init__(self, client_stats):
+        """ Initialize the objects instance
+
+        Arguments:
+            self - object - This object
+            client_stats - ClientStats object - Shared client statistics
+
+        Returns:
+            None
+        """
+
+        self.client_stats = client_stats
+        self.video_kind = VIDEO_KIND_DEFAULT
+        self.current_client = None
+        self._tried_clients = []
+
+    def next_client(self):
+        """ Choose the best client not yet tried for this video
+
+        Arguments:
+            self - object - This object
+
+        Returns:
+            client - string - Player client name
+        """
+
+        ranked_clients = self.client_stats.ranked_clients(self.video_kind)
+        untried_clients = [client for client in ranked_clients if client not in self._tried_clients]
+        if len(untried_clients) == 0:
+            # Every client failed once, so start over from the best
+            self._tried_clients = []
+            untried_clients = ranked_clients
+
+        self.current_client = untried_clients[0]
+        self._tried_clients.append(self.current_client)
+        return self.current_client
+
+    def record_success(self, latency):
+        """ Record that the last attempt succeeded
+
+        Arguments:
+            self - object - This object
+            latency - float - Seconds until the client had resolved the streams
+
+        Returns:
+            None
+        """
+
+        self.client_stats.record(self.current_client, self.video_kind, OUTCOME_SUCCESS, latency)
+
+    def record_failure(self, error, latency):
+        """ Record that the last attempt failed
+
+        Arguments:
+            self - object - This object
+            error - Exception object - Error the attempt raised
+            latency - float - Seconds the attempt took
+
+        Returns:
+            None
+        """
+
+        # The error reveals the video is age restricted, so this attempt and
+        # the remaining ones are ranked by how clients fare on those videos
+        if isinstance(error, AgeRestrictedError):
+            self.video_kind = VIDEO_KIND_AGE_RESTRICTED
+
+        self.client_stats.record(self.current_client, self.video_kind, type(error).__name__, latency)
@@ -0,0 +1,169 @@
+"""
+lib/cover_art.py
+
+Contains classes and functions related to fetching cover art images and
+keeping them in a content-addressed cache on disk, so each image is only
+downloaded and resized once no matter how many tracks embed it
+"""
+
+import os
+import socket
+import hashlib
+import functools
+import subprocess
+import urllib.error
+import urllib.request
+from urllib.parse import urlparse
+
+# Seconds to wait on a stalled image fetch before giving up on it
+FETCH_TIMEOUT = 30
+
+class CoverArtCache(object):
+    """ Contains methods that fetch, process, and cache cover art
+
+    Methods:
+        __init__() - Initialize the object
+        get_cover_art() - Get the cached cover art for a URL or local image
+    """
+
+    def __init__(self, config, db_manager):
+        """ Initialize the objects instance
+
+        Arguments:
+            self - object - This object
+            config - ConfigParser object - Configuration data
+            db_manager - DatabaseManager object - DB manager object instance
+
+        Returns:
+            None
+        """
+
+        self.config = config
+        self.db_manager = db_manager
+        self.cache_dir = os.path.expanduser(config["Tagging"]["cover_art_cache_directory"])
+        self.image_size = int(config["Tagging"]["cover_art_size"])
+        self.image_quality = int(config["Tagging"]["cover_art_quality"])
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Fetch through the same proxies the downloads use
+        if config["Download"]["use_proxies"] == "yes":
+            proxies = {
+                "http": config["Download"]["http_proxy"],
+                "https": config["Download"]["https_proxy"]
+            }
+            self.url_opener = urllib.request.build_opener(urllib.request.ProxyHandler(proxies))
+        else:
+            self.url_opener = urllib.request.build_opener()
+
+    def _cached_file(self, content_hash):
+        """ Get the cache filepath for an image at the configured size
+
+        Arguments:
+            self - object - This object
+            content_hash - string - Hash of the original image
+
+        Returns:
+            cached_file - filepath - Processed image location
+        """
+
+        cached_file = os.path.join(self.cache_dir, "{0}_{1}q{2}.jpg".format(content_hash, self.image_size, self.image_quality))
+        return cached_file
+
+    def _process(self, image_data, cached_file):
+        """ Resize and recompress an image into the cache
+
+        Arguments:
+            self - object - This object
+            image_data - bytes - Original image
+            cached_file - filepath - Where to store the processed image
+
+        Returns:
+            None
+        """
+
+        # Work on temporary names so a failed run never leaves a bad entry
+        original_file = "{}.orig".format(cached_file)
+        partial_file = "{}.part".format(cached_file)
+        with open(original_file, "wb") as image_file:
+            image_file.write(image_data)
+
+        scale_filter = "scale='min({0},iw)':'min({0},ih)':force_original_aspect_ratio=decrease".format(self.image_size)
+        convert_command = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", original_file,
+            "-vf", scale_filter, "-frames:v", "1", "-q:v", str(self.image_quality),
+            "-f", "image2", "-c:v", "mjpeg", partial_file
+        ]
+        try:
+            subprocess.check_output(convert_command)
+            os.replace(partial_file, cached_file)
+        finally:
+            os.remove(original_file)
+            if os.path.isfile(partial_file) == True:
+                os.remove(partial_file)
+
+    def get_cover_art(self, source):
+        """ Get the cached cover art for a URL or local image, fetching
+        and processing it only if it is not cached yet
+
+        Arguments:
+            self - object - This object
+            source - string - Image URL or local image filepath
+
+        Returns:
+            cached_file - filepath - Processed image location, None if unavailable
+        """
+
+        is_url = urlparse(source).scheme in ("http", "https")
+
+        # Skip the download entirely if this URL was already fetched
+        if is_url == True:
+            content_hash = self.db_manager.get_cover_art_hash(source)
+            if content_hash != None:
+                cached_file = self._cached_file(content_hash)
+                if os.path.isfile(cached_file) == True:
+                    return cached_file
+
+        # Cover art is optional, so a failure here must not stop the run
+        try:
+            # Fetch the original image
+            if is_url == True:
+                with self.url_opener.open(source, timeout=FETCH_TIMEOUT) as response:
+                    image_data = response.read()
+            else:
+                with open(source, "rb") as image_file:
+                    image_data = image_file.read()
+
+            # Different sources often serve identical images, so key by content
+            content_hash = hashlib.sha256(image_data).hexdigest()
+            cached_file = self._cached_file(content_hash)
+            if os.path.isfile(cached_file) == False:
+                self._process(image_data, cached_file)
+
+        except (urllib.error.URLError, TimeoutError, socket.timeout, OSError) as err_msg:
+            print("[ERROR] Cannot get cover art from {0}: {1}".format(source, err_msg))
+            return None
+
+        except subprocess.CalledProcessError as err_msg:
+            print("[ERROR] Cannot process cover art from {0}: {1}".format(source, err_msg))
+            return None
+
+        if is_url == True:
+            self.db_manager.add_cover_art_hash(source, content_hash)
+
+        return cached_file
+
+
+@functools.lru_cache(maxsize=32)
+def read_cover_art(cached_file):
+    """ Read a cached cover art image, shared by every track that embeds it
+
+    Arguments:
+        cached_file - filepath - Processed image location
+
+    Returns:
+        image_data - bytes - JPEG image data
+    """
+
+    with open(cached_file, "rb") as image_file:
+        image_data = image_file.read()
+    return image_data
@@ -14,6 +14,10 @@ class DatabaseManager(object):
     Methods:
         __init__() - Initialize the object
         add_song_to_db() - Add a song to the database
+        get_cover_art_hash() - Look up the cached cover art for a source
+        add_cover_art_hash() - Record the cached cover art for a source
+        get_client_stats() - Get the recorded player client statistics
+        set_client_stats() - Store player client statistics
     """
     
     def __init__(self, debug_mode, database_file):
@@ -59,6 +63,79 @@ class DatabaseManager(object):
         
         is_success = True
         return is_success
+        
+    def get_cover_art_hash(self, source):
+        """ Look up the content hash of the cover art fetched from a source
+        
+        Arguments:
+            self - object - This object
+            source - string - Image URL
+            
+        Returns:
+            content_hash - string - Hash of the fetched image, None if not cached
+        """
+        
+        sql_statement = "SELECT content_hash FROM cover_art WHERE source = ?"
+        self.db_cur.execute(sql_statement, (source,))
+        row = self.db_cur.fetchone()
+        
+        if row == None:
+            content_hash = None
+        else:
+            content_hash = row[0]
+        return content_hash
+        
+    def add_cover_art_hash(self, source, content_hash):
+        """ Record the content hash of the cover art fetched from a source
+        
+        Arguments:
+            self - object - This object
+            source - string - Image URL
+            content_hash - string - Hash of the fetched image
+            
+        Returns:
+            is_success - bool - True if successful
+        """
+        
+        sql_statement = "INSERT OR REPLACE INTO cover_art VALUES (?, ?)"
+        self.db_cur.execute(sql_statement, (source, content_hash))
+        self.db_con.commit()
+        
+        is_success = True
+        return is_success
+        
+    def get_client_stats(self):
+        """ Get the recorded player client statistics
+        
+        Arguments:
+            self - object - This object
+            
+        Returns:
+            client_stats - list - (client, video_kind, outcome, attempts, total_latency, updated_at) rows
+        """
+        
+        sql_statement = "SELECT client, video_kind, outcome, attempts, total_latency, updated_at FROM client_stats"
+        self.db_cur.execute(sql_statement)
+        client_stats = self.db_cur.fetchall()
+        return client_stats
+        
+    def set_client_stats(self, client_stats):
+        """ Store player client statistics, replacing any existing rows
+        
+        Arguments:
+            self - object - This object
+            client_stats - list - (client, video_kind, outcome, attempts, total_latency, updated_at) rows
+            
+        Returns:
+            is_success - bool - True if successful
+        """
+        
+        sql_statement = "INSERT OR REPLACE INTO client_stats VALUES (?, ?, ?, ?, ?, ?)"
+        self.db_cur.executemany(sql_statement, client_stats)
+        self.db_con.commit()
+        
+        is_success = True
+        return is_success
        
 
 def db_init_check(database_file):
@@ -75,20 +152,24 @@ def db_init_check(database_file):
     # Check if the database exists yet
     if os.path.isfile(database_file) == True:
         db_already_exists = True
-        return db_already_exists
-        
     else:
-        # Create the DB
-        db_con = sqlite3.connect(database_file)
-        db_cur = db_con.cursor()
-        
-        # Initialize the tables
-        sql_statement = "CREATE TABLE song_tag_data(yt_video_url, title, artist, genre, album, track_num, release_year)"
-        db_cur.execute(sql_statement)
-        db_con.commit()
-        
         db_already_exists = False
-        return db_already_exists
+        
+    # Create the DB if needed
+    db_con = sqlite3.connect(database_file)
+    db_cur = db_con.cursor()
+    
+    # Initialize the tables, including any added since the DB was created
+    sql_statement = "CREATE TABLE IF NOT EXISTS song_tag_data(yt_video_url, title, artist, genre, album, track_num, release_year)"
+    db_cur.execute(sql_statement)
+    sql_statement = "CREATE TABLE IF NOT EXISTS cover_art(source PRIMARY KEY, content_hash)"
+    db_cur.execute(sql_statement)
+    sql_statement = "CREATE TABLE IF NOT EXISTS client_stats(client, video_kind, outcome, attempts, total_latency, updated_at, PRIMARY KEY(client, video_kind, outcome))"
+    db_cur.execute(sql_statement)
+    db_con.commit()
+    db_con.close()
+    
+    return db_already_exists
         
         
         
\ No newline at end of file
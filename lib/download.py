@@ -6,37 +6,192 @@ from YouTube
 """
 
 import os
+import time
 import subprocess
 import eyed3
-from urllib.urlparse import urlparse
+from eyed3.id3.frames import ImageFrame
+from urllib.parse import urlparse
 from pytubefix import YouTube
 from pytubefix.exceptions import AgeRestrictedError, VideoRegionBlocked, VideoUnavailable, PytubeError
-from pytubefix.innertube import _default_clients
+from lib import loudness
+from lib import cover_art
+from lib import client_selection
 
-def _convert(raw_audio_file, dl_filename):
+# Bytes of analysis PCM read from ffmpeg at a time
+PCM_CHUNK_SIZE = 1024 * 1024
+
+# Audio stream selection policies
+STREAM_SELECTION_POLICIES = ("first", "smallest_meeting_output", "preferred_codec", "closest_to_output")
+
+def _stream_kbps(stream):
+    """ Get the nominal bitrate of an audio stream
+    
+    Arguments:
+        stream - Stream object - Audio stream
+        
+    Returns:
+        kbps - int - Bitrate in kbps, 0 if unknown
+    """
+    
+    if stream.abr != None:
+        kbps = int(stream.abr.rstrip("kbps"))
+    elif stream.bitrate != None:
+        kbps = stream.bitrate // 1000
+    else:
+        kbps = 0
+    return kbps
+
+def _stream_size(stream):
+    """ Get the size of an audio stream without any extra requests.
+    Stream.filesize sends a HEAD request when YouTube did not report the
+    size, so the reported size is used when present and otherwise it is
+    estimated from bitrate and duration
+    
+    Arguments:
+        stream - Stream object - Audio stream
+        
+    Returns:
+        size - float - Size in bytes, infinity if it cannot be told
+    """
+    
+    reported_size = getattr(stream, "_filesize", 0)
+    duration_ms = getattr(stream, "durationMs", None)
+    if reported_size:
+        size = reported_size
+    elif stream.bitrate and duration_ms:
+        size = stream.bitrate * int(duration_ms) / 8000
+    else:
+        # Ranked after sized streams, then by bitrate alone
+        size = float("inf")
+    return size
+
+def _smallest_meeting(streams, target_kbps):
+    """ Get the smallest stream at or above a bitrate, or the best
+    stream below it when none reach it
+    
+    Arguments:
+        streams - list - Audio streams
+        target_kbps - int - Target bitrate in kbps
+        
+    Returns:
+        stream - Stream object - Chosen stream
+    """
+    
+    meeting = [stream for stream in streams if _stream_kbps(stream) >= target_kbps]
+    if len(meeting) > 0:
+        stream = min(meeting, key=lambda stream: (_stream_size(stream), _stream_kbps(stream)))
+    else:
+        stream = max(streams, key=lambda stream: (_stream_kbps(stream), -_stream_size(stream)))
+    return stream
+
+def _select_audio_stream(config, streams):
+    """ Choose the audio stream to download for the configured policy
+    
+    Arguments:
+        config - ConfigParser object - Configuration data
+        streams - StreamQuery object - Available streams
+        
+    Returns:
+        raw_audio - Stream object - Chosen audio stream
+    """
+    
+    policy = config["Download"]["stream_selection"]
+    audio_streams = list(streams.filter(only_audio=True))
+    if policy not in STREAM_SELECTION_POLICIES:
+        print("[ERROR] Invalid stream selection policy specified in config: {}!".format(policy))
+        policy = "first"
+    if policy == "first" or len(audio_streams) == 0:
+        raw_audio = streams.filter(only_audio=True).first()
+        return raw_audio
+        
+    target_kbps = int(config["Download"]["output_bitrate_kbps"])
+    
+    if policy == "smallest_meeting_output":
+        raw_audio = _smallest_meeting(audio_streams, target_kbps)
+        
+    elif policy == "preferred_codec":
+        preferred_codec = config["Download"]["preferred_codec"]
+        preferred_streams = [stream for stream in audio_streams if stream.audio_codec != None and stream.audio_codec.startswith(preferred_codec)]
+        if len(preferred_streams) == 0:
+            preferred_streams = audio_streams
+        raw_audio = _smallest_meeting(preferred_streams, target_kbps)
+        
+    elif policy == "closest_to_output":
+        raw_audio = min(audio_streams, key=lambda stream: (abs(_stream_kbps(stream) - target_kbps), _stream_size(stream)))
+        
+    return raw_audio
+
+def _convert(raw_audio_file, dl_filename, loudness_meter=None, output_bitrate_kbps=None):
     """ Convert raw audio to MP3
     
     Arguments:
         raw_audio_file - filename - Downloaded raw audio
         dl_filename - filename - Desired MP3 filename
+        loudness_meter - LoudnessMeter object - If given, fed the decoded PCM
+        output_bitrate_kbps - int - MP3 bitrate, ffmpeg's default if not given
         
     Returns:
         mp3_filename - filename - Name of converted file
     """
     
-    convert_command = """ffmpeg -hide_banner -loglevel error -i "{0}" "{1}" """.format(raw_audio_file, dl_filename)
-    subprocess.check_output(convert_command, shell=True)
+    if output_bitrate_kbps != None:
+        bitrate_options = ["-b:a", "{}k".format(output_bitrate_kbps)]
+    else:
+        bitrate_options = []
+    
+    if loudness_meter == None:
+        convert_command = """ffmpeg -hide_banner -loglevel error -i "{0}" {1} "{2}" """.format(raw_audio_file, " ".join(bitrate_options), dl_filename)
+        subprocess.check_output(convert_command, shell=True)
+        
+    else:
+        # Split the single decode between the MP3 encoder and a PCM pipe
+        # used for loudness analysis
+        filter_graph = "[0:a]asplit=2[enc][ana];[ana]{0}[pcm]".format(loudness_meter.analysis_filter())
+        convert_command = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-i", raw_audio_file,
+            "-filter_complex", filter_graph,
+            "-map", "[enc]", *bitrate_options, dl_filename,
+            "-map", "[pcm]", "-f", "f32le", "pipe:1"
+        ]
+        ffmpeg_proc = subprocess.Popen(convert_command, stdout=subprocess.PIPE)
+        while True:
+            pcm_chunk = ffmpeg_proc.stdout.read(PCM_CHUNK_SIZE)
+            if not pcm_chunk:
+                break
+            loudness_meter.feed(pcm_chunk)
+        ffmpeg_proc.stdout.close()
+        if ffmpeg_proc.wait() != 0:
+            raise subprocess.CalledProcessError(ffmpeg_proc.returncode, convert_command)
+            
     os.remove(raw_audio_file)
     
     mp3_filename = dl_filename
     return mp3_filename
     
-def _tag(dl_filename, song_tag_data):
+def _probe_channels(raw_audio_file):
+    """ Read the channel count of the raw audio from its header
+    
+    Arguments:
+        raw_audio_file - filename - Downloaded raw audio
+        
+    Returns:
+        channels - int - Number of audio channels
+    """
+    
+    probe_command = [
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "stream=channels", "-of", "csv=p=0", raw_audio_file
+    ]
+    channels = int(subprocess.check_output(probe_command).decode().strip())
+    return channels
+    
+def _tag(dl_filename, song_tag_data, track_gain=None):
     """ Add tags to downloaded MP3
     
     Arguments:
         dl_filename - filename - MP3 file to tag
         song_tag_data - dict - Song tag data
+        track_gain - float - ReplayGain track gain in dB, if measured
         
     Returns:
         is_successful - bool - True if successul
@@ -50,12 +205,39 @@ def _tag(dl_filename, song_tag_data):
     mp3_file.tag.album = song_tag_data["album"]
     mp3_file.tag.track_num = song_tag_data["track_num"]
     mp3_file.tag.year = song_tag_data["release_year"]
+    if song_tag_data["cover_art"] != None:
+        mp3_file.tag.images.set(ImageFrame.FRONT_COVER, cover_art.read_cover_art(song_tag_data["cover_art"]), "image/jpeg")
+    if track_gain != None:
+        mp3_file.tag.user_text_frames.set("{:.2f} dB".format(track_gain), "REPLAYGAIN_TRACK_GAIN")
     mp3_file.tag.save()
     
     is_successful = True
     return is_successful
 
-def download_thread(config, yt_video_url, dl_filename, song_tag_data):
+def tag_album_gain(album_loudness):
+    """ Add the album gain tag to every track of a finished album
+    
+    Arguments:
+        album_loudness - AlbumLoudness object - Loudness of each finished track
+        
+    Returns:
+        is_successful - bool - True if successful
+    """
+    
+    album_gain = album_loudness.album_gain()
+    if album_gain == None:
+        is_successful = False
+        return is_successful
+        
+    for mp3_filename in album_loudness.tracks:
+        mp3_file = eyed3.load(mp3_filename)
+        mp3_file.tag.user_text_frames.set("{:.2f} dB".format(album_gain), "REPLAYGAIN_ALBUM_GAIN")
+        mp3_file.tag.save()
+        
+    is_successful = True
+    return is_successful
+
+def download_thread(config, yt_video_url, dl_filename, song_tag_data, album_loudness=None, scratch_space=None, client_stats=None):
     """ Download raw audio then convert and add tags
     
     Arguments:
@@ -63,17 +245,27 @@ def download_thread(config, yt_video_url, dl_filename, song_tag_data):
         yt_video_url - string - Songs YouTube video URL
         dl_filename - filename - MP3 filename for download
         song_tag_data - dict - Song tag data
+        album_loudness - AlbumLoudness object - Collects loudness for the album gain
+        scratch_space - ScratchSpace object - If given, work there instead of the library
+        client_stats - ClientStats object - Shared player client statistics
         
     Returns:
         None
     """
     
-    # Define possible default clients
-    default_client_list = ["ANDROID_CREATOR", "ANDROID", "WEB"]
-    backup_client_num = 0
+    reserved_bytes = 0
+    raw_audio_file = None
+    
+    # Choose clients for this thread only, best performing first
+    if client_stats == None:
+        client_stats = client_selection.ClientStats(config)
+    client_selector = client_selection.ClientSelector(client_stats)
     
     # Attempt to download until success or retry limit reached
-    for attempt in range(config["Download"]["max_retries"]):
+    for attempt in range(int(config["Download"]["max_retries"])):
+        client = client_selector.next_client()
+        attempt_start = time.monotonic()
+        
         # Check OAuth settings
         if config["Download"]["use_oauth"] == "yes":
             use_oauth = True
@@ -94,45 +286,104 @@ def download_thread(config, yt_video_url, dl_filename, song_tag_data):
                 "https": urlparse(https_proxy).netloc
             }
 
-            yt = YouTube(yt_video_url, proxies=proxies, use_oauth=use_oauth, allow_oauth_cache=allow_oauth_cache)
+            yt = YouTube(yt_video_url, client=client, proxies=proxies, use_oauth=use_oauth, allow_oauth_cache=allow_oauth_cache)
         else:
-            yt = YouTube(yt_video_url, use_oauth=use_oauth, allow_oauth_cache=allow_oauth_cache)
+            yt = YouTube(yt_video_url, client=client, use_oauth=use_oauth, allow_oauth_cache=allow_oauth_cache)
         
         # Attempt the download and handle errors
         try:
-            raw_audio = yt.streams.filter(only_audio=True).first()
-            raw_audio_file = raw_audio.download()
+            # Only time the client, the download itself depends on file size
+            streams = yt.streams
+            client_latency = time.monotonic() - attempt_start
+            raw_audio = _select_audio_stream(config, streams)
+            if scratch_space != None:
+                # Keep the raw audio off the library until it is finished
+                raw_audio_size = _stream_size(raw_audio)
+                if raw_audio_size == float("inf"):
+                    raw_audio_size = 0
+                reserved_bytes = scratch_space.reserve(int(raw_audio_size))
+                try:
+                    raw_audio_file = raw_audio.download(output_path=scratch_space.scratch_dir, filename_prefix="{} ".format(yt.video_id))
+                except:
+                    scratch_space.release(reserved_bytes)
+                    reserved_bytes = 0
+                    raise
+            else:
+                raw_audio_file = raw_audio.download()
+            client_selector.record_success(client_latency)
             break
             
         except AgeRestrictedError as err_msg:
-            # Handle video being age restricted
+            # Handle video being age restricted, the next attempt uses
+            # the client that does best on age restricted videos
             print("[ERROR] Video is age restricted. Attempting to bypass.")
             if use_oauth == False:
                 print("[ERROR] If issue persists, enable OAuth support")
-                
-            _default_clients["ANDROID_MUSIC"] = _default_clients[default_client_list[backup_client_num]]
-            
-            if backup_client_num < len(default_client_list) - 1:
-                backup_client_num = backup_client_num + 1
-            elif backup_client_num == len(default_client_list) - 1:
-                backup_client_num = 0
-                
+            client_selector.record_failure(err_msg, time.monotonic() - attempt_start)
             continue
             
         except VideoRegionBlocked as err_msg:
             # Handle video being region blocked
             print("[ERROR] Video is region blocked. Try a proxy or VPN in another country")
+            client_selector.record_failure(err_msg, time.monotonic() - attempt_start)
             continue
             
         except VideoUnavailable as err_msg:
             # Handle generic video unavailable error
             print("[ERROR] Video unavailable: {}".format(err_msg))
+            client_selector.record_failure(err_msg, time.monotonic() - attempt_start)
             continue
             
         except PytubeError as err_msg:
             # Handle technical PyTube errors
             print("[ERROR] PyTube error: {}".format(err_msg))
+            client_selector.record_failure(err_msg, time.monotonic() - attempt_start)
             continue
     
-    _convert(raw_audio_file, dl_filename)
-    _tag(dl_filename, song_tag_data)
\ No newline at end of file
+    if raw_audio_file == None:
+        print("[ERROR] Giving up on {} after {} attempts".format(yt_video_url, config["Download"]["max_retries"]))
+        return
+    
+    # Convert and tag in the scratch directory if enabled
+    if scratch_space != None:
+        mp3_filename = scratch_space.scratch_file(yt.video_id, dl_filename)
+    else:
+        mp3_filename = dl_filename
+    is_finished = False
+    
+    try:
+        # Measure loudness from the conversion decode if enabled
+        if config["Tagging"]["add_replaygain_tags"] == "yes":
+            loudness_meter = loudness.LoudnessMeter(_probe_channels(raw_audio_file))
+        else:
+            loudness_meter = None
+        
+        _convert(raw_audio_file, mp3_filename, loudness_meter=loudness_meter, output_bitrate_kbps=int(config["Download"]["output_bitrate_kbps"]))
+        
+        track_gain = None
+        if loudness_meter != None:
+            block_energies = loudness_meter.block_energies()
+            track_gain = loudness.replaygain(block_energies)
+            
+        _tag(mp3_filename, song_tag_data, track_gain=track_gain)
+        
+        if loudness_meter != None and album_loudness != None:
+            album_loudness.add_track(mp3_filename, block_energies)
+        
+        # Move the finished MP3 into the library. Album tracks still need the
+        # album gain, so they are finalized once every track has finished
+        if scratch_space != None:
+            if album_loudness != None:
+                scratch_space.defer_finalize(mp3_filename, dl_filename)
+            else:
+                scratch_space.finalize(mp3_filename, dl_filename)
+        is_finished = True
+        
+    finally:
+        # Never leave intermediate files or claimed room behind on failure
+        if os.path.isfile(raw_audio_file) == True:
+            os.remove(raw_audio_file)
+        if scratch_space != None:
+            if is_finished == False and os.path.isfile(mp3_filename) == True:
+                os.remove(mp3_filename)
+            scratch_space.release(reserved_bytes)
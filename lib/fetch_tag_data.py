@@ -49,10 +49,13 @@ class TagDataFetcher(object):
             "genre": None,
             "album": None,
             "track_num": None,
-            "release_year": None
+            "release_year": None,
+            "thumbnail_url": None,
+            "cover_art": None
         }
         
         yt = YouTube(yt_video_url)
+        song_tag_data["thumbnail_url"] = yt.thumbnail_url
         
         # Automatic tagging mode
         if self.config["Tagging"]["tag_mode"] == "automatic":
@@ -0,0 +1,232 @@
+"""
+lib/loudness.py
+
+Contains classes and functions related to measuring track and album
+loudness for ReplayGain tagging. The measurement is fed from the PCM
+that ffmpeg already decodes while converting to MP3, so no extra
+decode pass over the downloaded audio is needed
+"""
+
+import threading
+import numpy as np
+
+# ReplayGain 2.0 reference loudness, in LUFS
+REFERENCE_LOUDNESS = -18.0
+
+# Sample rate of the analysis PCM produced by ffmpeg
+ANALYSIS_SAMPLE_RATE = 48000
+
+# ffmpeg filter chain applied to the analysis branch only. Approximates
+# the ITU-R BS.1770 K-weighting pre-filter and RLB high-pass
+_ANALYSIS_FILTER = "aresample={0},highshelf=f=1681:g=4:t=q:w=0.7071,highpass=f=38:t=q:w=0.5,aformat=sample_fmts=flt:channel_layouts={1}"
+
+# Gating block parameters (400ms blocks, 75% overlap)
+_SUB_BLOCK_SAMPLES = ANALYSIS_SAMPLE_RATE // 10
+_SUB_BLOCKS_PER_BLOCK = 4
+_ABSOLUTE_GATE = -70.0
+_RELATIVE_GATE = -10.0
+
+class LoudnessMeter(object):
+    """ Accumulates gating block energies from a stream of
+    interleaved float32 PCM
+
+    Methods:
+        __init__() - Initialize the object
+        feed() - Add a chunk of raw PCM bytes
+        analysis_filter() - Get the ffmpeg filter chain for the analysis PCM
+        block_energies() - Get the mean square energy of each gating block
+    """
+
+    def __init__(self, source_channels):
+        """ Initialize the objects instance
+
+        Arguments:
+            self - object - This object
+            source_channels - int - Channel count of the audio being measured
+
+        Returns:
+            None
+        """
+
+        # Mono is piped as one channel but measured as dual mono, since it
+        # plays on both speakers (EBU Tech 3341). Surround is downmixed
+        if source_channels == 1:
+            self.channels = 1
+            self._energy_weight = 2.0
+        else:
+            self.channels = 2
+            self._energy_weight = 1.0
+        self._pending = np.empty((0, self.channels), dtype=np.float32)
+        self._pending_bytes = b""
+        self._sub_block_energies = []
+
+    def feed(self, pcm_chunk):
+        """ Add a chunk of raw PCM bytes
+
+        Arguments:
+            self - object - This object
+            pcm_chunk - bytes - Interleaved little endian float32 samples
+
+        Returns:
+            None
+        """
+
+        # Chunks from the pipe are not guaranteed to end on a frame boundary
+        frame_size = 4 * self.channels
+        data = self._pending_bytes + pcm_chunk
+        usable = len(data) - (len(data) % frame_size)
+        self._pending_bytes = data[usable:]
+        if usable == 0:
+            return
+
+        frames = np.frombuffer(data[:usable], dtype="<f4").reshape(-1, self.channels)
+        frames = np.concatenate((self._pending, frames))
+
+        # Reduce every complete 100ms sub-block to its summed channel energy
+        sub_block_count = len(frames) // _SUB_BLOCK_SAMPLES
+        complete = frames[:sub_block_count * _SUB_BLOCK_SAMPLES].astype(np.float64)
+        if sub_block_count > 0:
+            squares = np.square(complete).reshape(sub_block_count, _SUB_BLOCK_SAMPLES, self.channels)
+            self._sub_block_energies.append(squares.mean(axis=1).sum(axis=1) * self._energy_weight)
+        self._pending = frames[sub_block_count * _SUB_BLOCK_SAMPLES:]
+
+    def analysis_filter(self):
+        """ Get the ffmpeg filter chain that produces this meters PCM
+
+        Arguments:
+            self - object - This object
+
+        Returns:
+            analysis_filter - string - ffmpeg filter chain
+        """
+
+        if self.channels == 1:
+            channel_layout = "mono"
+        else:
+            channel_layout = "stereo"
+        analysis_filter = _ANALYSIS_FILTER.format(ANALYSIS_SAMPLE_RATE, channel_layout)
+        return analysis_filter
+
+    def block_energies(self):
+        """ Get the mean square energy of each 400ms gating block
+
+        Arguments:
+            self - object - This object
+
+        Returns:
+            energies - ndarray - Energy of each overlapping gating block
+        """
+
+        if len(self._sub_block_energies) == 0:
+            return np.empty(0, dtype=np.float64)
+
+        sub_blocks = np.concatenate(self._sub_block_energies)
+        if len(sub_blocks) < _SUB_BLOCKS_PER_BLOCK:
+            # Tracks shorter than one block are measured as a single block
+            return np.array([sub_blocks.mean()])
+
+        window = np.full(_SUB_BLOCKS_PER_BLOCK, 1.0 / _SUB_BLOCKS_PER_BLOCK)
+        energies = np.convolve(sub_blocks, window, mode="valid")
+        return energies
+
+class AlbumLoudness(object):
+    """ Collects the gating blocks of every track in an album so
+    the album gain can be computed once all tracks have finished
+
+    Methods:
+        __init__() - Initialize the object
+        add_track() - Record a finished tracks gating blocks
+        album_gain() - Compute the album gain
+    """
+
+    def __init__(self):
+        """ Initialize the objects instance
+
+        Arguments:
+            self - object - This object
+
+        Returns:
+            None
+        """
+
+        self._lock = threading.Lock()
+        self.tracks = {}
+
+    def add_track(self, mp3_filename, block_energies):
+        """ Record a finished tracks gating blocks
+
+        Arguments:
+            self - object - This object
+            mp3_filename - filepath - Converted MP3 file
+            block_energies - ndarray - Tracks gating block energies
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            self.tracks[mp3_filename] = block_energies
+
+    def album_gain(self):
+        """ Compute the album gain from every recorded track
+
+        Arguments:
+            self - object - This object
+
+        Returns:
+            gain - float - Album gain in dB, None if nothing was measured
+        """
+
+        with self._lock:
+            if len(self.tracks) == 0:
+                return None
+            all_blocks = np.concatenate(list(self.tracks.values()))
+
+        gain = replaygain(all_blocks)
+        return gain
+
+
+def integrated_loudness(block_energies):
+    """ Compute the gated integrated loudness of a set of blocks
+
+    Arguments:
+        block_energies - ndarray - Gating block energies
+
+    Returns:
+        loudness - float - Integrated loudness in LUFS, None if silent
+    """
+
+    if len(block_energies) == 0:
+        return None
+
+    with np.errstate(divide="ignore"):
+        block_loudness = -0.691 + 10.0 * np.log10(block_energies)
+
+    # Absolute gate
+    gated = block_energies[block_loudness > _ABSOLUTE_GATE]
+    if len(gated) == 0:
+        return None
+
+    # Relative gate
+    relative_threshold = -0.691 + 10.0 * np.log10(gated.mean()) + _RELATIVE_GATE
+    gated = block_energies[(block_loudness > _ABSOLUTE_GATE) & (block_loudness > relative_threshold)]
+
+    loudness = float(-0.691 + 10.0 * np.log10(gated.mean()))
+    return loudness
+
+def replaygain(block_energies):
+    """ Compute the ReplayGain adjustment for a set of blocks
+
+    Arguments:
+        block_energies - ndarray - Gating block energies
+
+    Returns:
+        gain - float - Gain in dB, None if silent
+    """
+
+    loudness = integrated_loudness(block_energies)
+    if loudness == None:
+        return None
+
+    gain = REFERENCE_LOUDNESS - loudness
+    return gain
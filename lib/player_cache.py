@@ -0,0 +1,377 @@
+"""
+lib/player_cache.py
+
+Contains classes and functions related to caching the pytubefix Cipher
+built from YouTube's player JavaScript. Building one parses the player,
+starts two node processes, and loads the decipher functions into them,
+which pytubefix otherwise repeats for every video. Ciphers are kept per
+player version and shared by every download thread, and the decipher
+function names found in the player are persisted on disk so later runs
+skip that parse until YouTube ships a new version
+"""
+
+import os
+import re
+import json
+import atexit
+import hashlib
+import threading
+import pytubefix
+from pytubefix import extract, exceptions
+from pytubefix.cipher import Cipher
+
+# Player version as it appears in the base.js URL
+PLAYER_VERSION_PATTERN = re.compile(r"/s/player/([0-9A-Za-z_-]+)/")
+
+# Cipher attribute that holds the extra arguments found for each function
+_PARAM_ATTRIBUTES = {
+    "sig": "_sig_param_val",
+    "nsig": "_nsig_param_val"
+}
+
+# pytubefix internals the cache replaces or calls into
+_REQUIRED_INTERNALS = (
+    (extract, "Cipher"),
+    (Cipher, "get_sig_function_name"),
+    (Cipher, "get_nsig_function_name"),
+    (Cipher, "get_sig"),
+    (Cipher, "get_nsig"),
+    (exceptions, "InterpretationError")
+)
+
+class PlayerCache(object):
+    """ Contains methods that cache Ciphers and decipher function names
+    by player version
+
+    Methods:
+        __init__() - Initialize the object
+        get_cipher() - Get the shared Cipher for a player
+        invalidate() - Drop everything cached for a player version
+        get_function_name() - Get a decipher function name for a player
+        shutdown() - Stop the node processes of every cached Cipher
+        install() - Route pytubefix through this cache
+    """
+
+    def __init__(self, config):
+        """ Initialize the objects instance
+
+        Arguments:
+            self - object - This object
+            config - ConfigParser object - Configuration data
+
+        Returns:
+            None
+        """
+
+        self.cache_dir = os.path.expanduser(config["Download"]["player_cache_directory"])
+        self.max_versions = int(config["Download"]["player_cache_max_versions"])
+        self._lock = threading.Lock()
+        # Player version -> CachedCipher, oldest first
+        self._ciphers = {}
+        self._functions = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _cache_file(self, version):
+        """ Get the on disk filepath for a player version
+
+        Arguments:
+            self - object - This object
+            version - string - Player version
+
+        Returns:
+            cache_file - filepath - Cache file location
+        """
+
+        cache_file = os.path.join(self.cache_dir, "{0}.json".format(version))
+        return cache_file
+
+    def _write_file(self, cache_file, contents):
+        """ Atomically write a cache file, then prune old player versions
+
+        Arguments:
+            self - object - This object
+            cache_file - filepath - Cache file location
+            contents - string - File contents
+
+        Returns:
+            None
+        """
+
+        partial_file = "{0}.{1}.part".format(cache_file, threading.get_ident())
+        with open(partial_file, "w", encoding="utf-8") as part_file:
+            part_file.write(contents)
+        os.replace(partial_file, cache_file)
+
+        # Keep only the most recently used player versions on disk
+        json_files = [name for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+        json_files.sort(key=lambda name: os.path.getmtime(os.path.join(self.cache_dir, name)), reverse=True)
+        for name in json_files[self.max_versions:]:
+            os.remove(os.path.join(self.cache_dir, name))
+
+    def get_cipher(self, js, js_url):
+        """ Get the shared Cipher for a player, building it only if this
+        player version has not been seen in this run yet. Takes the same
+        arguments as Cipher, so it can stand in for it in pytubefix
+
+        Arguments:
+            self - object - This object
+            js - string - Player JavaScript
+            js_url - string - Player base.js URL
+
+        Returns:
+            cipher - CachedCipher object - Cipher for this player version
+        """
+
+        version = player_version(js_url)
+        evicted_ciphers = []
+        with self._lock:
+            cipher = self._ciphers.get(version)
+            if cipher == None:
+                # Built under the lock so threads that start together
+                # do not each start their own node processes
+                cipher = CachedCipher(self, js, js_url)
+                self._ciphers[version] = cipher
+                while len(self._ciphers) > self.max_versions:
+                    evicted_ciphers.append(self._ciphers.pop(next(iter(self._ciphers))))
+
+        for evicted_cipher in evicted_ciphers:
+            evicted_cipher.shutdown()
+        return cipher
+
+    def invalidate(self, js_url):
+        """ Drop everything cached for a player version
+
+        Arguments:
+            self - object - This object
+            js_url - string - Player base.js URL
+
+        Returns:
+            None
+        """
+
+        version = player_version(js_url)
+        with self._lock:
+            cipher = self._ciphers.pop(version, None)
+            self._functions.pop(version, None)
+            cache_file = self._cache_file(version)
+            if os.path.isfile(cache_file) == True:
+                os.remove(cache_file)
+
+        if cipher != None:
+            cipher.shutdown()
+
+    def get_function_name(self, kind, cipher, js, js_url, extract_function_name):
+        """ Get a decipher function name for a player, parsing the player
+        JavaScript only if this player version has not been cached yet
+
+        Arguments:
+            self - object - This object
+            kind - string - "sig" or "nsig"
+            cipher - Cipher object - Cipher being built
+            js - string - Player JavaScript
+            js_url - string - Player base.js URL
+            extract_function_name - function - Uncached pytubefix extractor
+
+        Returns:
+            function_name - string - Name of the decipher function
+        """
+
+        # Called while get_cipher() holds the lock, so no locking here
+        version = player_version(js_url)
+        param_attribute = _PARAM_ATTRIBUTES[kind]
+        cache_file = self._cache_file(version)
+        functions = self._functions.get(version)
+        if functions == None:
+            functions = {}
+            if os.path.isfile(cache_file) == True:
+                with open(cache_file, "r", encoding="utf-8") as cached_functions:
+                    cached = json.load(cached_functions)
+                # Names found by another pytubefix release may come from
+                # extraction patterns that release has since fixed
+                if cached.get("pytubefix_version") == pytubefix.__version__:
+                    functions = cached["functions"]
+                    os.utime(cache_file)
+            self._functions[version] = functions
+
+        if kind in functions:
+            function_name, param_val = functions[kind]
+            setattr(cipher, param_attribute, param_val)
+            return function_name
+
+        function_name = extract_function_name(cipher, js, js_url)
+        functions[kind] = [function_name, getattr(cipher, param_attribute)]
+        cached = {
+            "pytubefix_version": pytubefix.__version__,
+            "functions": functions
+        }
+        self._write_file(cache_file, json.dumps(cached))
+        return function_name
+
+    def shutdown(self):
+        """ Stop the node processes of every cached Cipher
+
+        Arguments:
+            self - object - This object
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            ciphers = list(self._ciphers.values())
+            self._ciphers = {}
+
+        for cipher in ciphers:
+            cipher.shutdown()
+
+    def install(self):
+        """ Route pytubefix's Cipher construction through this cache
+
+        Arguments:
+            self - object - This object
+
+        Returns:
+            is_installed - bool - False if this pytubefix release is unsupported
+        """
+
+        for owner, name in _REQUIRED_INTERNALS:
+            if hasattr(owner, name) == False:
+                print("[ERROR] Player cache does not support pytubefix {0}, missing {1}. Continuing without it".format(pytubefix.__version__, name))
+                is_installed = False
+                return is_installed
+
+        # extract.apply_signature() builds its Cipher through this name
+        extract.Cipher = self.get_cipher
+        atexit.register(self.shutdown)
+
+        is_installed = True
+        return is_installed
+
+class CachedCipher(Cipher):
+    """ A Cipher shared by every download thread using the same player
+    version. Node processes are not thread safe and get_nsig() keeps state
+    between calls, so deciphering is serialized per Cipher
+
+    Methods:
+        __init__() - Initialize the object
+        get_sig_function_name() - Get the signature function name
+        get_nsig_function_name() - Get the n-parameter function name
+        get_sig() - Decipher a signature
+        get_nsig() - Decipher an n-parameter
+        shutdown() - Stop the node processes
+    """
+
+    def __init__(self, player_cache, js, js_url):
+        """ Initialize the objects instance
+
+        Arguments:
+            self - object - This object
+            player_cache - PlayerCache object - Cache that owns this Cipher
+            js - string - Player JavaScript
+            js_url - string - Player base.js URL
+
+        Returns:
+            None
+        """
+
+        self.player_cache = player_cache
+        # Reentrant, as a failed decipher shuts down its own Cipher
+        self._lock = threading.RLock()
+        Cipher.__init__(self, js=js, js_url=js_url)
+
+        # apply_signature() closes the runners after every video, which
+        # would restart both node processes on the next one
+        self.runner_sig = SharedNodeRunner(self.runner_sig)
+        self.runner_nsig = SharedNodeRunner(self.runner_nsig)
+
+    def get_sig_function_name(self, js, js_url):
+        return self.player_cache.get_function_name("sig", self, js, js_url, Cipher.get_sig_function_name)
+
+    def get_nsig_function_name(self, js, js_url):
+        return self.player_cache.get_function_name("nsig", self, js, js_url, Cipher.get_nsig_function_name)
+
+    # A bad cached function name only shows up when deciphering, which
+    # pytubefix does not retry, so drop the version there
+    def get_sig(self, ciphered_signature):
+        with self._lock:
+            try:
+                return Cipher.get_sig(self, ciphered_signature)
+            except exceptions.InterpretationError:
+                self.player_cache.invalidate(self.js_url)
+                raise
+
+    def get_nsig(self, n):
+        with self._lock:
+            try:
+                return Cipher.get_nsig(self, n)
+            except exceptions.InterpretationError:
+                self.player_cache.invalidate(self.js_url)
+                raise
+
+    def shutdown(self):
+        """ Stop the node processes. A thread still holding this Cipher
+        gets them restarted by pytubefix on its next call
+
+        Arguments:
+            self - object - This object
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            self.runner_sig.shutdown()
+            self.runner_nsig.shutdown()
+
+class SharedNodeRunner(object):
+    """ Wraps a pytubefix NodeRunner so that closing it after a single
+    video leaves the node process running for the next one
+
+    Methods:
+        __init__() - Initialize the object
+        close() - Ignored, the owning CachedCipher decides when to stop
+        shutdown() - Stop the node process
+    """
+
+    def __init__(self, node_runner):
+        """ Initialize the objects instance
+
+        Arguments:
+            self - object - This object
+            node_runner - NodeRunner object - Runner to share
+
+        Returns:
+            None
+        """
+
+        self.node_runner = node_runner
+
+    def __getattr__(self, name):
+        return getattr(self.node_runner, name)
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        self.node_runner.close()
+
+
+def player_version(js_url):
+    """ Get the cache key for a base.js URL. The same player version is
+    served in several variants and locales, so the key includes a short
+    hash of the full URL alongside the version
+
+    Arguments:
+        js_url - string - Player base.js URL
+
+    Returns:
+        version - string - Player version cache key
+    """
+
+    url_hash = hashlib.sha256(js_url.encode("utf-8")).hexdigest()
+    match = PLAYER_VERSION_PATTERN.search(js_url)
+    if match != None:
+        version = "{0}_{1}".format(match.group(1), url_hash[:8])
+    else:
+        version = url_hash[:16]
+    return version
@@ -0,0 +1,162 @@
+"""
+lib/scratch.py
+
+Contains classes and functions related to the scratch directory, where
+raw downloads and partially written MP3s live until they are finished
+and atomically moved into the music library
+"""
+
+import os
+import errno
+import shutil
+import threading
+
+class ScratchSpace(object):
+    """ Contains methods that manage a size capped scratch directory
+    shared by all download threads
+
+    Methods:
+        __init__() - Initialize the object
+        reserve() - Wait for and claim room for a download
+        release() - Give back room claimed by reserve()
+        scratch_file() - Get a scratch filepath for a download
+        finalize() - Atomically move a finished file into the library
+        defer_finalize() - Queue a finished file to be finalized later
+        finalize_deferred() - Finalize every queued file
+    """
+
+    def __init__(self, config):
+        """ Initialize the objects instance
+
+        Arguments:
+            self - object - This object
+            config - ConfigParser object - Configuration data
+
+        Returns:
+            None
+        """
+
+        self.scratch_dir = os.path.abspath(os.path.expanduser(config["Download"]["scratch_directory"]))
+        self.max_bytes = int(config["Download"]["scratch_directory_max_mb"]) * 1024 * 1024
+        self.used_bytes = 0
+        self.deferred_files = []
+        self._condition = threading.Condition()
+        os.makedirs(self.scratch_dir, exist_ok=True)
+
+    def reserve(self, raw_audio_size):
+        """ Wait until there is room for a download, then claim it. Room
+        is claimed for both the raw audio and the MP3 converted from it.
+        The cap covers downloads in progress. Album tracks waiting for
+        finalize_deferred() are not counted, so a thread never blocks on
+        room that only frees up after every thread has finished
+
+        Arguments:
+            self - object - This object
+            raw_audio_size - int - Size of the raw audio stream in bytes
+
+        Returns:
+            reserved_bytes - int - Bytes claimed, to be passed to release()
+        """
+
+        reserved_bytes = raw_audio_size * 2
+        with self._condition:
+            # A download larger than the cap may still run on its own
+            while self.used_bytes > 0 and self.used_bytes + reserved_bytes > self.max_bytes:
+                self._condition.wait()
+            self.used_bytes = self.used_bytes + reserved_bytes
+        return reserved_bytes
+
+    def release(self, reserved_bytes):
+        """ Give back room claimed by reserve()
+
+        Arguments:
+            self - object - This object
+            reserved_bytes - int - Bytes returned by reserve()
+
+        Returns:
+            None
+        """
+
+        with self._condition:
+            self.used_bytes = self.used_bytes - reserved_bytes
+            self._condition.notify_all()
+
+    def scratch_file(self, yt_video_id, filename):
+        """ Get a scratch filepath for a download
+
+        Arguments:
+            self - object - This object
+            yt_video_id - string - Video ID, keeps concurrent downloads apart
+            filename - filename - Final filename of the download
+
+        Returns:
+            scratch_file - filepath - Location in the scratch directory
+        """
+
+        scratch_file = os.path.join(self.scratch_dir, "{0} {1}".format(yt_video_id, filename))
+        return scratch_file
+
+    def finalize(self, scratch_file, library_file):
+        """ Atomically move a finished file into the library
+
+        Arguments:
+            self - object - This object
+            scratch_file - filepath - Finished file in the scratch directory
+            library_file - filepath - Final location in the library
+
+        Returns:
+            library_file - filepath - Final location in the library
+        """
+
+        try:
+            os.replace(scratch_file, library_file)
+        except OSError as err_msg:
+            if err_msg.errno != errno.EXDEV:
+                raise
+
+            # Different filesystems, so copy next to the target then rename
+            partial_file = "{}.part".format(library_file)
+            try:
+                shutil.copyfile(scratch_file, partial_file)
+                os.replace(partial_file, library_file)
+            finally:
+                if os.path.isfile(partial_file) == True:
+                    os.remove(partial_file)
+            os.remove(scratch_file)
+
+        return library_file
+
+    def defer_finalize(self, scratch_file, library_file):
+        """ Queue a finished file to be finalized later, for files that
+        still need album level tags once every track has finished
+
+        Arguments:
+            self - object - This object
+            scratch_file - filepath - Finished file in the scratch directory
+            library_file - filepath - Final location in the library
+
+        Returns:
+            None
+        """
+
+        with self._condition:
+            self.deferred_files.append((scratch_file, os.path.abspath(library_file)))
+
+    def finalize_deferred(self):
+        """ Finalize every queued file
+
+        Arguments:
+            self - object - This object
+
+        Returns:
+            library_files - list - Final locations in the library
+        """
+
+        with self._condition:
+            deferred_files = self.deferred_files
+            self.deferred_files = []
+
+        library_files = []
+        for scratch_file, library_file in deferred_files:
+            library_files.append(self.finalize(scratch_file, library_file))
+        return library_files
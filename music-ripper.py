@@ -26,6 +26,11 @@ from pytubefix import YouTube, Playlist
 from lib import database
 from lib import fetch_tag_data
 from lib import download
+from lib import loudness
+from lib import cover_art
+from lib import scratch
+from lib import client_selection
+from lib import player_cache
 
 def _show_banner():
     """ Print the banner message
@@ -154,6 +159,7 @@ def main(argv):
     config_file = "cfg/config.ini"
     target_video_url = None
     target_playlist_url = None
+    thumbnail_file = None
         
     for opt, arg in opts:
         if opt in ("-h", "--help"):
@@ -205,6 +211,15 @@ def main(argv):
             # Specify to download an album from a given Playlist URL
             target_playlist_url = arg
             
+        elif opt in ("-t", "--thumbnail"):
+            # Manually specify a thumbnail image to add
+            if os.path.isfile(os.path.abspath(arg)) == True:
+                thumbnail_file = os.path.abspath(arg)
+            else:
+                # Specified file not found error
+                print("[ERROR] Cannot find specified thumbnail image: {}!".format(arg))
+                exit(1)
+            
     # Display the banner message
     _show_banner()
             
@@ -223,9 +238,27 @@ def main(argv):
     # Create a database manager
     db_manager = database.DatabaseManager(debug_mode, config["Database"]["database_file"])
             
+    # Load player client statistics from previous runs
+    client_stats = client_selection.ClientStats(config)
+    client_stats.load(db_manager)
+            
     # Show program settings
     _show_settings_details(config_file, config["Database"]["database_file"])
     
+    # Share one decipher Cipher per player version across threads
+    if config["Download"]["use_player_cache"] == "yes":
+        was_installed = player_cache.PlayerCache(config).install()
+        # DEBUG MESSAGE
+        if debug_mode == True:
+            if was_installed == False:
+                print("[DEBUG] Player cache was not installed")
+    
+    # Set up the scratch directory for intermediate files if enabled
+    if config["Download"]["use_scratch_directory"] == "yes":
+        scratch_space = scratch.ScratchSpace(config)
+    else:
+        scratch_space = None
+    
     # Change to configured base working directory
     os.chdir(config["DEFAULT"]["base_working_directory"])
     
@@ -248,12 +281,22 @@ def main(argv):
             print("[DEBUG]: Value of song_tag_data:")
             print(song_tag_data)
             
+        # Fetch cover art through the cache if enabled
+        cover_art_source = None
+        if thumbnail_file != None:
+            cover_art_source = thumbnail_file
+        elif config["Tagging"]["add_video_thumbnail_to_file"] == "yes":
+            cover_art_source = song_tag_data["thumbnail_url"]
+        if cover_art_source != None:
+            cover_art_cache = cover_art.CoverArtCache(config, db_manager)
+            song_tag_data["cover_art"] = cover_art_cache.get_cover_art(cover_art_source)
+            
         # Display download init message
         _init_dl_message()
         
         # Download the song
         dl_filename = "{0} - {1}.mp3".format(target_video_url, song_tag_data["title"])
-        dl_thread = threading.Thread(target=download_thread, args=(config, target_video_url, dl_filename, song_tag_data))
+        dl_thread = threading.Thread(target=download.download_thread, args=(config, target_video_url, dl_filename, song_tag_data, None, scratch_space, client_stats))
         print("[Download thread initialized for song]: {}".format(target_video_url))
         dl_thread.start()
         dl_thread.join()
@@ -285,6 +328,23 @@ def main(argv):
         if debug_mode == True:
             print("[DEBUG] Value of dl_queue:")
             print(dl_queue)
+            
+        # Fetch cover art through the cache if enabled. A shared album
+        # image takes precedence over each videos own thumbnail
+        add_video_thumbnails = config["Tagging"]["add_video_thumbnail_to_file"] == "yes"
+        add_album_thumbnail = config["Tagging"]["include_thumbnail_image_in_album"] == "yes"
+        if thumbnail_file != None or add_video_thumbnails or add_album_thumbnail:
+            cover_art_cache = cover_art.CoverArtCache(config, db_manager)
+            album_cover_art = None
+            if thumbnail_file != None:
+                album_cover_art = cover_art_cache.get_cover_art(thumbnail_file)
+            elif add_album_thumbnail and len(dl_queue) > 0:
+                album_cover_art = cover_art_cache.get_cover_art(dl_queue[0][1]["thumbnail_url"])
+            for song in dl_queue:
+                if album_cover_art != None:
+                    song[1]["cover_art"] = album_cover_art
+                elif add_video_thumbnails:
+                    song[1]["cover_art"] = cover_art_cache.get_cover_art(song[1]["thumbnail_url"])
         
             
         # Add songs to DB
@@ -302,13 +362,19 @@ def main(argv):
         # Display download init message
         _init_dl_message()
         
+        # Collect track loudness for the album gain if enabled
+        if config["Tagging"]["add_replaygain_tags"] == "yes":
+            album_loudness = loudness.AlbumLoudness()
+        else:
+            album_loudness = None
+        
         # Initialize download threads
         dl_threads = []
         for song in dl_queue:
             url = song[0]
             data = song[1]
             dl_filename = "{0}. {1}.mp3".format(data["track_num"], data["title"])
-            dl_thread = threading.Thread(target=download.download_thread, args=(config, url, dl_filename, data))
+            dl_thread = threading.Thread(target=download.download_thread, args=(config, url, dl_filename, data, album_loudness, scratch_space, client_stats))
             print("[Download thread initialized for song]: {}".format(url))
             dl_threads.append(dl_thread)
         print("")
@@ -330,6 +396,29 @@ def main(argv):
                 if config["Download"]["add_delay_between_downloads"] == "yes":
                     time.wait(int(config["Download"]["delay_length_ms"]))
                 dl_thread.join()
+                
+        # Add the album gain now that every track has been measured. The
+        # tracks are moved into the library even if tagging fails, so they
+        # are never left behind in the scratch directory
+        try:
+            if album_loudness != None:
+                was_tagged = download.tag_album_gain(album_loudness)
+                # DEBUG MESSAGE
+                if debug_mode == True:
+                    if was_tagged == False:
+                        print("[DEBUG] No album gain could be computed")
+                        
+        finally:
+            # Move the fully tagged tracks into the library
+            if scratch_space != None:
+                scratch_space.finalize_deferred()
+            
+    # Save this runs player client statistics for future runs
+    was_saved = client_stats.save(db_manager)
+    # DEBUG MESSAGE
+    if debug_mode == True:
+        if was_saved == False:
+            print("[DEBUG] Error saving player client statistics to DB")
             
     # Display completion message
     _dl_complete_message()
@@ -11,5 +11,6 @@ setup(
         "pytube",
         "pytubefix",
         "eyed3",
+        "numpy",
     ],
 )
\ No newline at end of file